@@ -1,8 +1,14 @@
+import asyncio
 import secrets
+import sqlite3
 import hashlib
-from datetime import datetime, timedelta
+import hmac
+import string
+import threading
+import time
 from typing import Optional
 from fastapi import APIRouter, HTTPException, Response, Request, Depends
+from cachetools import TTLCache
 import bcrypt
 
 from app.database import get_db
@@ -12,32 +18,96 @@ from app.email_service import send_verification_email
 
 router = APIRouter(prefix="/api/auth", tags=["auth"])
 
-def hash_token(token: str) -> str:
-    return hashlib.sha256(token.encode()).hexdigest()
+# Verification and reset codes are valid for 15 minutes
+CODE_EXPIRE_SECONDS = 15 * 60
+
+# secrets.token_urlsafe(32) always yields 43 URL-safe base64 characters;
+# anything else can't be a session token, so skip the hash and DB lookup
+SESSION_TOKEN_LENGTH = 43
+_TOKEN_CHARS = frozenset(string.ascii_letters + string.digits + "-_")
+
+# Session statements run on nearly every request; kept as constants so each
+# pooled connection's statement cache reuses the same prepared statement
+SQL_GET_SESSION = '''
+    SELECT u.id, u.email, u.name, u.email_verified, s.expires_at
+    FROM users u
+    JOIN sessions s ON u.id = s.user_id
+    WHERE s.token_hash = ? AND s.expires_at > ?
+'''
+SQL_INSERT_SESSION = "INSERT INTO sessions (user_id, token_hash, expires_at) VALUES (?, ?, ?)"
+SQL_DELETE_SESSION = "DELETE FROM sessions WHERE token_hash = ?"
+
+# Short-lived cache of session lookups: {token_hash: (user, expires_at)}
+# Kept under a minute so account changes propagate quickly.
+_session_cache = TTLCache(maxsize=10_000, ttl=60)
+_session_cache_lock = threading.Lock()
+# Token hashes logged out within the cache TTL; never re-cached
+_revoked_tokens = TTLCache(maxsize=10_000, ttl=60)
+
+# bcrypt salts generated ahead of time by fill_salt_pool(), started from the app lifespan
+SALT_POOL_SIZE = 64
+_salt_pool: Optional[asyncio.Queue] = None
+
+def hash_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+async def fill_salt_pool():
+    global _salt_pool
+    # A queue binds to the loop that first waits on it, so each lifespan gets a fresh one
+    pool = _salt_pool = asyncio.Queue(maxsize=SALT_POOL_SIZE)
+    while True:
+        salt = await asyncio.to_thread(bcrypt.gensalt, settings.BCRYPT_ROUNDS)
+        await pool.put(salt)
+
+async def hash_password(password: str) -> str:
+    if _salt_pool is not None and not _salt_pool.empty():
+        salt = _salt_pool.get_nowait()
+    else:
+        salt = bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)
+    # bcrypt releases the GIL, so hashing on a worker thread keeps the event loop free
+    hashed = await asyncio.to_thread(bcrypt.hashpw, password.encode(), salt)
+    return hashed.decode()
+
+async def check_password(password: str, password_hash: str) -> bool:
+    return await asyncio.to_thread(bcrypt.checkpw, password.encode(), password_hash.encode())
+
+def codes_match(stored_hash: Optional[bytes], code_hash: bytes) -> bool:
+    # Constant-time, so response timing doesn't reveal how much of the code matched
+    return stored_hash is not None and hmac.compare_digest(stored_hash, code_hash)
 
 def generate_verification_code() -> str:
-    return ''.join([str(secrets.randbelow(10)) for _ in range(6)])
+    return f"{secrets.randbelow(1_000_000):06d}"
 
-def get_current_user(request: Request) -> Optional[dict]:
-    token = request.cookies.get("session_token")
-    if not token:
+def get_current_user(request: Request) -> Optional[sqlite3.Row]:
+    # Memoized on the request so every dependency that needs the user shares one lookup
+    if not hasattr(request.state, "user"):
+        request.state.user = lookup_session_user(request.cookies.get("session_token"))
+    return request.state.user
+
+def lookup_session_user(token: Optional[str]) -> Optional[sqlite3.Row]:
+    if not token or len(token) != SESSION_TOKEN_LENGTH or not _TOKEN_CHARS.issuperset(token):
         return None
     
     token_hash = hash_token(token)
+    now = int(time.time())
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+    if cached and cached[1] > now:
+        return cached[0]
+    
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT u.id, u.email, u.name, u.email_verified 
-            FROM users u
-            JOIN sessions s ON u.id = s.user_id
-            WHERE s.token_hash = ? AND s.expires_at > ?
-        ''', (token_hash, datetime.utcnow().isoformat()))
+        cursor.execute(SQL_GET_SESSION, (token_hash, now))
         row = cursor.fetchone()
-        if row:
-            return dict(row)
-    return None
+    
+    if not row:
+        return None
+    with _session_cache_lock:
+        if token_hash not in _revoked_tokens:
+            _session_cache[token_hash] = (row, row["expires_at"])
+    return row
 
-def require_auth(request: Request) -> dict:
+def require_auth(request: Request) -> sqlite3.Row:
     user = get_current_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Not authenticated")
@@ -48,73 +118,72 @@ async def register(data: RegisterRequest):
     if len(data.password) < 8:
         raise HTTPException(status_code=400, detail="Password must be at least 8 characters")
     
-    password_hash = bcrypt.hashpw(data.password.encode(), bcrypt.gensalt()).decode()
+    password_hash = await hash_password(data.password)
     code = generate_verification_code()
     code_hash = hash_token(code)
-    expires = (datetime.utcnow() + timedelta(minutes=15)).isoformat()
+    expires = int(time.time()) + CODE_EXPIRE_SECONDS
     
-    with get_db() as conn:
-        cursor = conn.cursor()
-        # Check if user exists
-        cursor.execute("SELECT id, email_verified FROM users WHERE email = ?", (data.email.lower(),))
-        existing = cursor.fetchone()
-        
-        if existing:
-            if existing["email_verified"]:
-                raise HTTPException(status_code=400, detail="Email already registered")
-            # Update existing unverified user
-            cursor.execute('''
-                UPDATE users SET password_hash = ?, name = ?, 
-                verification_code_hash = ?, verification_expires = ?
-                WHERE email = ?
-            ''', (password_hash, data.name, code_hash, expires, data.email.lower()))
-        else:
-            cursor.execute('''
-                INSERT INTO users (email, password_hash, name, verification_code_hash, verification_expires)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (data.email.lower(), password_hash, data.name, code_hash, expires))
-        
-        conn.commit()
+    # SQLite calls block (writes can wait on busy_timeout), so they run on worker threads
+    await asyncio.to_thread(upsert_unverified_user, data, password_hash, code_hash, expires)
     
-    if not send_verification_email(data.email, code, data.name):
+    # smtplib blocks, so send from a worker thread
+    if not await asyncio.to_thread(send_verification_email, data.email, code, data.name):
         raise HTTPException(status_code=500, detail="Failed to send verification email")
     
     return {"message": "Verification code sent to your email"}
 
+def upsert_unverified_user(data: RegisterRequest, password_hash: str, code_hash: bytes, expires: int):
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # Insert new user, or refresh an existing unverified one; verified rows are left untouched
+        cursor.execute('''
+            INSERT INTO users (email, password_hash, name, verification_code_hash, verification_expires)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET
+                password_hash = excluded.password_hash,
+                name = excluded.name,
+                verification_code_hash = excluded.verification_code_hash,
+                verification_expires = excluded.verification_expires
+            WHERE users.email_verified = 0
+            RETURNING id
+        ''', (data.email.lower(), password_hash, data.name, code_hash, expires))
+        if not cursor.fetchall():
+            raise HTTPException(status_code=400, detail="Email already registered")
+        
+        conn.commit()
+
+# Like the notes handlers, routes with no awaits are plain functions so FastAPI runs
+# their SQLite work in its threadpool instead of on the event loop
 @router.post("/verify")
-async def verify(data: VerifyRequest, response: Response):
+def verify(data: VerifyRequest, response: Response):
     code_hash = hash_token(data.code)
     
     with get_db() as conn:
         cursor = conn.cursor()
+        # Take the write lock before reading so the later writes never need a lock upgrade
+        cursor.execute("BEGIN IMMEDIATE")
         cursor.execute('''
-            SELECT id, name, verification_expires FROM users 
-            WHERE email = ? AND verification_code_hash = ?
-        ''', (data.email.lower(), code_hash))
+            SELECT id, name, verification_code_hash, verification_expires FROM users 
+            WHERE email = ?
+        ''', (data.email.lower(),))
         user = cursor.fetchone()
         
-        if not user:
+        if not user or not codes_match(user["verification_code_hash"], code_hash):
             raise HTTPException(status_code=400, detail="Invalid verification code")
         
-        if datetime.fromisoformat(user["verification_expires"]) < datetime.utcnow():
+        if user["verification_expires"] < int(time.time()):
             raise HTTPException(status_code=400, detail="Verification code expired")
         
-        # Mark as verified
-        cursor.execute('''
-            UPDATE users SET email_verified = 1, verification_code_hash = NULL, verification_expires = NULL
-            WHERE id = ?
-        ''', (user["id"],))
-        
-        # Create session
         token = secrets.token_urlsafe(32)
         token_hash = hash_token(token)
-        expires = (datetime.utcnow() + timedelta(days=settings.SESSION_EXPIRE_DAYS)).isoformat()
-        
-        cursor.execute('''
-            INSERT INTO sessions (user_id, token_hash, expires_at)
-            VALUES (?, ?, ?)
-        ''', (user["id"], token_hash, expires))
+        expires = int(time.time()) + settings.SESSION_EXPIRE_DAYS * 24 * 60 * 60
         
+        # Mark as verified and create session in the same transaction
+        conn.execute('''
+            UPDATE users SET email_verified = 1, verification_code_hash = NULL, verification_expires = NULL
+            WHERE id = ?
+        ''', (user["id"],))
+        conn.execute(SQL_INSERT_SESSION, (user["id"], token_hash, expires))
         conn.commit()
     
     response.set_cookie(
@@ -130,32 +199,22 @@ async def verify(data: VerifyRequest, response: Response):
 
 @router.post("/login")
 async def login(data: LoginRequest, response: Response):
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, email, password_hash, name, email_verified FROM users WHERE email = ?
-        ''', (data.email.lower(),))
-        user = cursor.fetchone()
-        
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid email or password")
-        
-        if not bcrypt.checkpw(data.password.encode(), user["password_hash"].encode()):
-            raise HTTPException(status_code=401, detail="Invalid email or password")
-        
-        if not user["email_verified"]:
-            raise HTTPException(status_code=401, detail="Please verify your email first")
-        
-        # Create session
-        token = secrets.token_urlsafe(32)
-        token_hash = hash_token(token)
-        expires = (datetime.utcnow() + timedelta(days=settings.SESSION_EXPIRE_DAYS)).isoformat()
-        
-        cursor.execute('''
-            INSERT INTO sessions (user_id, token_hash, expires_at)
-            VALUES (?, ?, ?)
-        ''', (user["id"], token_hash, expires))
-        conn.commit()
+    user = await asyncio.to_thread(get_login_user, data.email.lower())
+    
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    
+    if not await check_password(data.password, user["password_hash"]):
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    
+    if not user["email_verified"]:
+        raise HTTPException(status_code=401, detail="Please verify your email first")
+    
+    # Create session
+    token = secrets.token_urlsafe(32)
+    token_hash = hash_token(token)
+    expires = int(time.time()) + settings.SESSION_EXPIRE_DAYS * 24 * 60 * 60
+    await asyncio.to_thread(insert_session, user["id"], token_hash, expires)
     
     response.set_cookie(
         key="session_token",
@@ -168,24 +227,38 @@ async def login(data: LoginRequest, response: Response):
     
     return {"message": "Login successful", "user": {"id": user["id"], "email": user["email"], "name": user["name"]}}
 
+def get_login_user(email: str) -> Optional[sqlite3.Row]:
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, email, password_hash, name, email_verified FROM users WHERE email = ?
+        ''', (email,))
+        return cursor.fetchone()
+
+def insert_session(user_id: int, token_hash: bytes, expires: int):
+    with get_db() as conn:
+        conn.execute(SQL_INSERT_SESSION, (user_id, token_hash, expires))
+
 @router.post("/logout")
-async def logout(request: Request, response: Response):
+def logout(request: Request, response: Response):
     token = request.cookies.get("session_token")
     if token:
         token_hash = hash_token(token)
         with get_db() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM sessions WHERE token_hash = ?", (token_hash,))
+            cursor.execute(SQL_DELETE_SESSION, (token_hash,))
             conn.commit()
+        # Evict only once the row is gone, and tombstone the token so a lookup that
+        # read the row before the DELETE can't put it back in the cache
+        with _session_cache_lock:
+            _session_cache.pop(token_hash, None)
+            _revoked_tokens[token_hash] = True
     
     response.delete_cookie("session_token")
     return {"message": "Logged out"}
 
 @router.get("/me")
-async def me(request: Request):
-    user = get_current_user(request)
-    if not user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+async def me(user: sqlite3.Row = Depends(require_auth)):
     return UserResponse(
         id=user["id"],
         email=user["email"],
@@ -194,7 +267,7 @@ async def me(request: Request):
     )
 
 @router.post("/forgot-password")
-async def forgot_password(data: dict):
+def forgot_password(data: dict):
     email = data.get("email", "").lower().strip()
     if not email:
         raise HTTPException(status_code=400, detail="Email is required")
@@ -210,7 +283,7 @@ async def forgot_password(data: dict):
         
         code = generate_verification_code()
         code_hash = hash_token(code)
-        expires = (datetime.utcnow() + timedelta(minutes=15)).isoformat()
+        expires = int(time.time()) + CODE_EXPIRE_SECONDS
         
         cursor.execute('''
             UPDATE users SET reset_code_hash = ?, reset_code_expires = ?
@@ -237,26 +310,37 @@ async def reset_password(data: dict):
     
     code_hash = hash_token(code)
     
+    user_id = await asyncio.to_thread(check_reset_code, email, code_hash)
+    password_hash = await hash_password(new_password)
+    await asyncio.to_thread(apply_password_reset, user_id, password_hash, code_hash)
+    
+    return {"message": "Password reset successfully"}
+
+def check_reset_code(email: str, code_hash: bytes) -> int:
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT id, reset_code_expires FROM users 
-            WHERE email = ? AND reset_code_hash = ?
-        ''', (email, code_hash))
+            SELECT id, reset_code_hash, reset_code_expires FROM users 
+            WHERE email = ?
+        ''', (email,))
         user = cursor.fetchone()
-        
-        if not user:
-            raise HTTPException(status_code=400, detail="Invalid reset code")
-        
-        if datetime.fromisoformat(user["reset_code_expires"]) < datetime.utcnow():
-            raise HTTPException(status_code=400, detail="Reset code expired")
-        
-        password_hash = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt()).decode()
-        
+    
+    if not user or not codes_match(user["reset_code_hash"], code_hash):
+        raise HTTPException(status_code=400, detail="Invalid reset code")
+    
+    if user["reset_code_expires"] < int(time.time()):
+        raise HTTPException(status_code=400, detail="Reset code expired")
+    
+    return user["id"]
+
+def apply_password_reset(user_id: int, password_hash: str, code_hash: bytes):
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # Re-check the code so it stays single-use if another reset finished while hashing
         cursor.execute('''
             UPDATE users SET password_hash = ?, reset_code_hash = NULL, reset_code_expires = NULL
-            WHERE id = ?
-        ''', (password_hash, user["id"]))
+            WHERE id = ? AND reset_code_hash = ?
+        ''', (password_hash, user_id, code_hash))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=400, detail="Invalid reset code")
         conn.commit()
-    
-    return {"message": "Password reset successfully"}
@@ -12,6 +12,9 @@ class Settings:
     SMTP_PASS: str = os.getenv("SMTP_PASS", "")
     FROM_EMAIL: str = os.getenv("FROM_EMAIL", "")
     DATABASE_PATH: str = os.getenv("DATABASE_PATH", "/app/data/scribe.db")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_CACHE_MB: int = int(os.getenv("DB_CACHE_MB", "64"))
     SESSION_EXPIRE_DAYS: int = 30
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "10"))
 
 settings = Settings()
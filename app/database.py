@@ -1,19 +1,73 @@
+import queue
 import sqlite3
+import time
+from typing import Optional
 from contextlib import contextmanager
 from app.config import settings
 
+# Email sends are rate limited per hour; older email_log rows are purged
+EMAIL_LOG_WINDOW = 60 * 60
+
+# Idle connections kept open so SQLite's page cache stays warm between requests
+_pool = queue.LifoQueue(maxsize=settings.DB_POOL_SIZE)
+
+# The page cache is private to each connection, so split one total budget across the
+# pool instead of giving every connection its own (the container is capped at 512M);
+# reads beyond it are served from the shared mmap and the OS page cache
+_CACHE_KIB_PER_CONN = settings.DB_CACHE_MB * 1024 // settings.DB_POOL_SIZE
+
+def _connect() -> sqlite3.Connection:
+    # Autocommit mode: multi-statement writes open their own BEGIN IMMEDIATE
+    conn = sqlite3.connect(settings.DATABASE_PATH, check_same_thread=False,
+                           cached_statements=256, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{_CACHE_KIB_PER_CONN}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+def _column_type(cursor, table: str, column: str) -> Optional[str]:
+    cursor.execute(f"PRAGMA table_info({table})")
+    for row in cursor.fetchall():
+        if row["name"] == column:
+            return row["type"]
+    return None
+
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(settings.DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
     try:
         yield conn
     finally:
-        conn.close()
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_db():
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            return
 
 def init_db():
     with get_db() as conn:
         cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        
+        # sessions.expires_at used to be ISO text; move the old table aside and copy it over below
+        legacy_sessions = _column_type(cursor, "sessions", "expires_at") == "TEXT"
+        if legacy_sessions:
+            cursor.execute('ALTER TABLE sessions RENAME TO sessions_legacy')
         
         # Users table
         cursor.execute('''
@@ -23,8 +77,8 @@ def init_db():
                 password_hash TEXT NOT NULL,
                 name TEXT NOT NULL,
                 email_verified INTEGER DEFAULT 0,
-                verification_code_hash TEXT,
-                verification_expires TEXT,
+                verification_code_hash BLOB,
+                verification_expires INTEGER,
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -34,8 +88,8 @@ def init_db():
             CREATE TABLE IF NOT EXISTS sessions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
-                token_hash TEXT UNIQUE NOT NULL,
-                expires_at TEXT NOT NULL,
+                token_hash BLOB UNIQUE NOT NULL,
+                expires_at INTEGER NOT NULL,
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
@@ -60,6 +114,24 @@ def init_db():
             )
         ''')
         
+        # Sent-email log backing the email rate limits
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                note_id INTEGER NOT NULL,
+                sent_at INTEGER NOT NULL
+            )
+        ''')
+        
+        if legacy_sessions:
+            cursor.execute('''
+                INSERT INTO sessions (id, user_id, token_hash, expires_at, created_at)
+                SELECT id, user_id, token_hash, CAST(strftime('%s', expires_at) AS INTEGER), created_at
+                FROM sessions_legacy
+            ''')
+            cursor.execute('DROP TABLE sessions_legacy')
+        
         # Add encounter_time column if it doesn't exist (migration for existing tables)
         try:
             cursor.execute('ALTER TABLE notes ADD COLUMN encounter_time TEXT')
@@ -68,18 +140,52 @@ def init_db():
         
         # Add reset code columns for forgot password feature
         try:
-            cursor.execute('ALTER TABLE users ADD COLUMN reset_code_hash TEXT')
+            cursor.execute('ALTER TABLE users ADD COLUMN reset_code_hash BLOB')
         except sqlite3.OperationalError:
             pass
         try:
-            cursor.execute('ALTER TABLE users ADD COLUMN reset_code_expires TEXT')
+            cursor.execute('ALTER TABLE users ADD COLUMN reset_code_expires INTEGER')
         except sqlite3.OperationalError:
             pass
         
+        # Code expiries used to be ISO text; convert them to unix seconds
+        for column in ("verification_expires", "reset_code_expires"):
+            if _column_type(cursor, "users", column) == "TEXT":
+                cursor.execute(f'ALTER TABLE users ADD COLUMN {column}_epoch INTEGER')
+                cursor.execute(f"UPDATE users SET {column}_epoch = CAST(strftime('%s', {column}) AS INTEGER)")
+                cursor.execute(f'ALTER TABLE users DROP COLUMN {column}')
+                cursor.execute(f'ALTER TABLE users RENAME COLUMN {column}_epoch TO {column}')
+        
+        # Token/code hashes are stored as raw SHA-256 digests; convert legacy hex values
+        for table, column in (("sessions", "token_hash"),
+                              ("users", "verification_code_hash"),
+                              ("users", "reset_code_hash")):
+            cursor.execute(f"SELECT rowid, {column} FROM {table} WHERE typeof({column}) = 'text'")
+            cursor.executemany(f"UPDATE {table} SET {column} = ? WHERE rowid = ?",
+                               [(bytes.fromhex(value), rowid) for rowid, value in cursor.fetchall()])
+        
         # Create indexes
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_token ON sessions(token_hash)')
+        # Covers the session check in get_current_user without touching the sessions table
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_cover ON sessions(token_hash, expires_at, user_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_log_user ON email_log(user_id, sent_at, note_id)')
+        # Covers list_notes: filter, ORDER BY and every listed column come from the index
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notes_list ON notes(
+                user_id, created_at DESC, label, patient_age, patient_gender, chief_complaint, encounter_time
+            )
+        ''')
+        
+        # Redundant with the indexes above and the UNIQUE constraint on users.email
+        cursor.execute('DROP INDEX IF EXISTS idx_sessions_token')
+        cursor.execute('DROP INDEX IF EXISTS idx_users_email')
+        cursor.execute('DROP INDEX IF EXISTS idx_notes_user')
+        cursor.execute('DROP INDEX IF EXISTS idx_notes_user_created')
         
         conn.commit()
+
+def purge_expired():
+    now = int(time.time())
+    with get_db() as conn:
+        conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
+        conn.execute("DELETE FROM email_log WHERE sent_at <= ?", (now - EMAIL_LOG_WINDOW,))
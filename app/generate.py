@@ -1,26 +1,55 @@
 import json
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 import anthropic
+import httpx
 
 from app.config import settings
 from app.auth import require_auth
-from app.models import ExtractRequest, ExtractResponse, GenerateRequest, GenerateResponse
+from app.models import ExtractRequest, ExtractResponse, GenerateRequest
 
 router = APIRouter(prefix="/api/generate", tags=["generate"])
 
-client = anthropic.Anthropic(api_key=settings.ANTHROPIC_API_KEY)
+# One async client for the process so TLS connections are reused across requests
+client = anthropic.AsyncAnthropic(
+    api_key=settings.ANTHROPIC_API_KEY,
+    max_retries=2,
+    http_client=anthropic.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    ),
+)
 
 EXTRACT_SYSTEM_PROMPT = """You are a medical transcription assistant. Analyze the following physician dictation and extract patient demographics and visit information.
 
-Return a JSON object with these fields:
+Record them with the record_demographics tool:
 - gender: "Male", "Female", or null if not mentioned
 - age: Patient age as string (e.g., "45", "3 months") or null if not mentioned
 - visitType: One of "New Patient", "Follow-up", "Annual Exam", "Urgent", "Consultation", or null if unclear
 - specialty: Medical specialty if apparent (e.g., "Family Medicine", "Cardiology", "Pediatrics") or null
 - chiefComplaint: Brief chief complaint (e.g., "chest pain", "annual wellness") or null
-- confidence: Float 0-1 indicating overall confidence in extractions
-
-Only return valid JSON, no other text."""
+- confidence: Float 0-1 indicating overall confidence in extractions"""
+
+# Forcing this tool makes the API return the fields as a parsed dict
+EXTRACT_TOOL = {
+    "name": "record_demographics",
+    "description": "Record patient demographics and visit information extracted from a dictation.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "gender": {"type": ["string", "null"], "enum": ["Male", "Female", None]},
+            "age": {"type": ["string", "null"]},
+            "visitType": {
+                "type": ["string", "null"],
+                "enum": ["New Patient", "Follow-up", "Annual Exam", "Urgent", "Consultation", None]
+            },
+            "specialty": {"type": ["string", "null"]},
+            "chiefComplaint": {"type": ["string", "null"]},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1}
+        },
+        "required": ["gender", "age", "visitType", "specialty", "chiefComplaint", "confidence"]
+    }
+}
 
 SOAP_SYSTEM_PROMPT = """You are a medical scribe assistant helping physicians create SOAP notes from their dictations.
 
@@ -110,29 +139,22 @@ Handle all dictation styles — rapid/terse, conversational, or detailed. Upgrad
 - Numbered assessment and plan items
 - Keep it scannable for quick review before pasting into EHR"""
 
-@router.post("/extract", response_model=ExtractResponse)
-async def extract_demographics(data: ExtractRequest, request: Request):
-    require_auth(request)
-    
+@router.post("/extract", response_model=ExtractResponse, dependencies=[Depends(require_auth)])
+async def extract_demographics(data: ExtractRequest):
     if not data.dictation or len(data.dictation.strip()) < 10:
         raise HTTPException(status_code=400, detail="Dictation too short")
     
     try:
-        response = client.messages.create(
+        response = await client.messages.create(
             model="claude-sonnet-4-20250514",
             max_tokens=500,
             system=EXTRACT_SYSTEM_PROMPT,
+            tools=[EXTRACT_TOOL],
+            tool_choice={"type": "tool", "name": EXTRACT_TOOL["name"]},
             messages=[{"role": "user", "content": data.dictation}]
         )
         
-        result_text = response.content[0].text.strip()
-        # Handle potential markdown code blocks
-        if result_text.startswith("```"):
-            lines = result_text.split("\n")
-            result_text = "\n".join(lines[1:-1]) if lines[-1] == "```" else "\n".join(lines[1:])
-        result_text = result_text.strip()
-        
-        result = json.loads(result_text)
+        result = response.content[0].input
         
         return ExtractResponse(
             gender=result.get("gender"),
@@ -142,32 +164,32 @@ async def extract_demographics(data: ExtractRequest, request: Request):
             chiefComplaint=result.get("chiefComplaint"),
             confidence=float(result.get("confidence", 0.5))
         )
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse AI response: {e}")
     except anthropic.APIError as e:
         raise HTTPException(status_code=500, detail=f"AI service error: {e}")
 
-@router.post("/soap", response_model=GenerateResponse)
-async def generate_soap(data: GenerateRequest, request: Request):
-    require_auth(request)
-    
+# The SOAP prompt is identical on every call, so let the API cache it
+SOAP_SYSTEM_BLOCKS = [{"type": "text", "text": SOAP_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+
+# (label, GenerateRequest attribute) pairs included in the SOAP prompt context
+SOAP_CONTEXT_FIELDS = (
+    ("Patient Gender", "gender"),
+    ("Patient Age", "age"),
+    ("Visit Type", "visitType"),
+    ("Specialty", "specialty"),
+    ("Chief Complaint", "chiefComplaint"),
+)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/soap", dependencies=[Depends(require_auth)])
+async def generate_soap(data: GenerateRequest):
+    """Stream the SOAP note as SSE: "delta" text events, then "done" with the full note (or "error")"""
     if not data.dictation or len(data.dictation.strip()) < 10:
         raise HTTPException(status_code=400, detail="Dictation too short")
     
     # Build context from demographics
-    context_parts = []
-    if data.gender:
-        context_parts.append(f"Patient Gender: {data.gender}")
-    if data.age:
-        context_parts.append(f"Patient Age: {data.age}")
-    if data.visitType:
-        context_parts.append(f"Visit Type: {data.visitType}")
-    if data.specialty:
-        context_parts.append(f"Specialty: {data.specialty}")
-    if data.chiefComplaint:
-        context_parts.append(f"Chief Complaint: {data.chiefComplaint}")
-    
-    context = "\n".join(context_parts) if context_parts else ""
+    context = "\n".join(f"{label}: {value}" for label, attr in SOAP_CONTEXT_FIELDS if (value := getattr(data, attr)))
     
     user_message = f"""Patient Context:
 {context}
@@ -177,15 +199,23 @@ Physician Dictation:
 
 Please generate a complete SOAP note from this dictation."""
     
-    try:
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=2000,
-            system=SOAP_SYSTEM_PROMPT,
-            messages=[{"role": "user", "content": user_message}]
-        )
-        
-        soap_note = response.content[0].text.strip()
-        return GenerateResponse(soap_note=soap_note)
-    except anthropic.APIError as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {e}")
+    async def events():
+        try:
+            async with client.messages.stream(
+                model="claude-sonnet-4-20250514",
+                max_tokens=2000,
+                system=SOAP_SYSTEM_BLOCKS,
+                messages=[{"role": "user", "content": user_message}]
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield sse_event("delta", {"text": text})
+                soap_note = (await stream.get_final_text()).strip()
+            yield sse_event("done", {"soap_note": soap_note})
+        except anthropic.APIError as e:
+            yield sse_event("error", {"detail": f"AI service error: {e}"})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,18 +1,38 @@
+import asyncio
+import logging
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, HTMLResponse
 from contextlib import asynccontextmanager
 
-from app.database import init_db
-from app.auth import router as auth_router
+from app.database import init_db, close_db, purge_expired
+from app.auth import router as auth_router, fill_salt_pool
 from app.notes import router as notes_router
 from app.generate import router as generate_router
 from app.transcribe import router as transcribe_router
 
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL = 10 * 60
+
+async def purge_periodically():
+    while True:
+        await asyncio.sleep(PURGE_INTERVAL)
+        # A failed pass (e.g. database is locked) must not end the task; retry next interval
+        try:
+            await asyncio.to_thread(purge_expired)
+        except Exception:
+            logger.exception("Periodic purge failed")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
+    purge_task = asyncio.create_task(purge_periodically())
+    salt_task = asyncio.create_task(fill_salt_pool())
     yield
+    purge_task.cancel()
+    salt_task.cancel()
+    close_db()
 
 app = FastAPI(title="QIScribe", lifespan=lifespan)
 
@@ -1,3 +1,4 @@
+import msgspec
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 from datetime import datetime
@@ -56,6 +57,14 @@ class NoteListItem(BaseModel):
     encounter_time: Optional[str]
     created_at: str
 
+# Serialization-only twin of NoteListItem for the list endpoint, generated from its
+# fields so the served and documented schemas can't drift; fields are in SELECT
+# order so a DB row maps onto it positionally
+NoteListRow = msgspec.defstruct(
+    "NoteListRow",
+    [(name, field.annotation) for name, field in NoteListItem.model_fields.items()],
+)
+
 # Generate models
 class ExtractRequest(BaseModel):
     dictation: str
@@ -75,6 +84,3 @@ class GenerateRequest(BaseModel):
     visitType: Optional[str] = None
     specialty: Optional[str] = None
     chiefComplaint: Optional[str] = None
-
-class GenerateResponse(BaseModel):
-    soap_note: str
@@ -1,16 +1,29 @@
-from typing import List
-from fastapi import APIRouter, HTTPException, Request, Depends
+import asyncio
+import sqlite3
+import time
+from typing import List, Optional
+import msgspec
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import ORJSONResponse, Response
 
-from app.database import get_db
+from app.database import get_db, EMAIL_LOG_WINDOW
 from app.auth import require_auth
-from app.models import NoteCreate, NoteResponse, NoteListItem
+from app.models import NoteCreate, NoteResponse, NoteListItem, NoteListRow
+from app.email_service import send_soap_note_email
 
-router = APIRouter(prefix="/api/notes", tags=["notes"])
+# Handlers that only touch SQLite are plain functions so FastAPI runs them in
+# its threadpool instead of blocking the event loop on disk I/O
+router = APIRouter(prefix="/api/notes", tags=["notes"], default_response_class=ORJSONResponse)
 
-@router.post("", response_model=NoteResponse)
-async def create_note(note: NoteCreate, request: Request):
-    user = require_auth(request)
-    
+# Columns returned to the client, taken from the response models once at import;
+# rows are serialized as-is, so the SELECT keys always match the documented schema
+NOTE_COLUMNS = ", ".join(NoteResponse.model_fields)
+NOTE_LIST_COLUMNS = ", ".join(NoteListRow.__struct_fields__)
+
+_list_encoder = msgspec.json.Encoder()
+
+@router.post("", responses={200: {"model": NoteResponse}})
+def create_note(note: NoteCreate, user: sqlite3.Row = Depends(require_auth)):
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
@@ -23,76 +36,41 @@ async def create_note(note: NoteCreate, request: Request):
         conn.commit()
         note_id = cursor.lastrowid
         
-        cursor.execute("SELECT * FROM notes WHERE id = ?", (note_id,))
+        cursor.execute(f"SELECT {NOTE_COLUMNS} FROM notes WHERE id = ?", (note_id,))
         row = cursor.fetchone()
     
-    return NoteResponse(
-        id=row["id"],
-        label=row["label"],
-        patient_age=row["patient_age"],
-        patient_gender=row["patient_gender"],
-        visit_type=row["visit_type"],
-        specialty=row["specialty"],
-        chief_complaint=row["chief_complaint"],
-        raw_dictation=row["raw_dictation"],
-        soap_note=row["soap_note"],
-        encounter_time=row["encounter_time"],
-        created_at=row["created_at"]
-    )
+    # Trusted data path - DB already validated at write time
+    return ORJSONResponse(dict(row))
 
-@router.get("", response_model=List[NoteListItem])
-async def list_notes(request: Request):
-    user = require_auth(request)
-    
+@router.get("", responses={200: {"model": List[NoteListItem]}})
+def list_notes(user: sqlite3.Row = Depends(require_auth)):
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, label, patient_age, patient_gender, chief_complaint, encounter_time, created_at 
+        cursor.execute(f'''
+            SELECT {NOTE_LIST_COLUMNS}
             FROM notes WHERE user_id = ?
             ORDER BY created_at DESC
         ''', (user["id"],))
         rows = cursor.fetchall()
     
-    return [NoteListItem(
-        id=row["id"],
-        label=row["label"],
-        patient_age=row["patient_age"],
-        patient_gender=row["patient_gender"],
-        chief_complaint=row["chief_complaint"],
-        encounter_time=row["encounter_time"],
-        created_at=row["created_at"]
-    ) for row in rows]
+    # Trusted data path - DB already validated at write time
+    return Response(_list_encoder.encode([NoteListRow(*row) for row in rows]), media_type="application/json")
 
-@router.get("/{note_id}", response_model=NoteResponse)
-async def get_note(note_id: int, request: Request):
-    user = require_auth(request)
-    
+@router.get("/{note_id}", responses={200: {"model": NoteResponse}})
+def get_note(note_id: int, user: sqlite3.Row = Depends(require_auth)):
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM notes WHERE id = ? AND user_id = ?", (note_id, user["id"]))
+        cursor.execute(f"SELECT {NOTE_COLUMNS} FROM notes WHERE id = ? AND user_id = ?", (note_id, user["id"]))
         row = cursor.fetchone()
     
     if not row:
         raise HTTPException(status_code=404, detail="Note not found")
     
-    return NoteResponse(
-        id=row["id"],
-        label=row["label"],
-        patient_age=row["patient_age"],
-        patient_gender=row["patient_gender"],
-        visit_type=row["visit_type"],
-        specialty=row["specialty"],
-        chief_complaint=row["chief_complaint"],
-        raw_dictation=row["raw_dictation"],
-        soap_note=row["soap_note"],
-        encounter_time=row["encounter_time"],
-        created_at=row["created_at"]
-    )
+    # Trusted data path - DB already validated at write time
+    return ORJSONResponse(dict(row))
 
 @router.delete("/{note_id}")
-async def delete_note(note_id: int, request: Request):
-    user = require_auth(request)
-    
+def delete_note(note_id: int, user: sqlite3.Row = Depends(require_auth)):
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM notes WHERE id = ? AND user_id = ?", (note_id, user["id"]))
@@ -102,73 +80,83 @@ async def delete_note(note_id: int, request: Request):
     
     return {"message": "Note deleted"}
 
-from datetime import datetime, timedelta
-from app.email_service import send_soap_note_email
+# Rate limits are kept in SQLite so every worker shares them and they survive restarts
+# Per-user locks (this process only), striped so the set stays fixed-size
+email_locks = [asyncio.Lock() for _ in range(256)]
 
-# Simple in-memory rate limiting
-email_counts = {}  # {user_id: [(timestamp, note_id), ...]}
-
-def check_rate_limit(user_id: int, note_id: int) -> tuple[bool, str]:
-    now = datetime.utcnow()
-    hour_ago = now - timedelta(hours=1)
-    
-    if user_id not in email_counts:
-        email_counts[user_id] = []
-    
-    # Clean old entries
-    email_counts[user_id] = [(ts, nid) for ts, nid in email_counts[user_id] if ts > hour_ago]
-    
-    # Check per-note limit (3 per note)
-    note_emails = sum(1 for ts, nid in email_counts[user_id] if nid == note_id)
-    if note_emails >= 3:
-        return False, "Maximum 3 emails per note reached"
-    
-    # Check per-hour limit (20 per user per hour)
-    if len(email_counts[user_id]) >= 20:
-        return False, "Maximum 20 emails per hour reached"
+def reserve_email(user_id: int, note_id: int) -> tuple[Optional[int], str]:
+    now = int(time.time())
+    with get_db() as conn:
+        cursor = conn.cursor()
+        # Count and log in one write transaction so concurrent requests, in any
+        # worker, can't both take the last slot
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute('''
+            SELECT COUNT(*) AS total, COALESCE(SUM(note_id = ?), 0) AS for_note
+            FROM email_log WHERE user_id = ? AND sent_at > ?
+        ''', (note_id, user_id, now - EMAIL_LOG_WINDOW))
+        counts = cursor.fetchone()
+        
+        # Check per-note limit (3 per note)
+        if counts["for_note"] >= 3:
+            return None, "Maximum 3 emails per note reached"
+        
+        # Check per-hour limit (20 per user per hour)
+        if counts["total"] >= 20:
+            return None, "Maximum 20 emails per hour reached"
+        
+        cursor.execute("INSERT INTO email_log (user_id, note_id, sent_at) VALUES (?, ?, ?)",
+                       (user_id, note_id, now))
+        conn.commit()
     
-    return True, ""
+    return cursor.lastrowid, ""
 
-def record_email(user_id: int, note_id: int):
-    if user_id not in email_counts:
-        email_counts[user_id] = []
-    email_counts[user_id].append((datetime.utcnow(), note_id))
+def release_email(log_id: int):
+    with get_db() as conn:
+        conn.execute("DELETE FROM email_log WHERE id = ?", (log_id,))
 
-@router.post("/{note_id}/email")
-async def email_note(note_id: int, request: Request):
-    user = require_auth(request)
-    
-    # Check rate limits
-    allowed, msg = check_rate_limit(user["id"], note_id)
-    if not allowed:
-        raise HTTPException(status_code=429, detail=msg)
-    
+def get_email_note(note_id: int, user_id: int) -> Optional[sqlite3.Row]:
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM notes WHERE id = ? AND user_id = ?", (note_id, user["id"]))
-        row = cursor.fetchone()
+        cursor.execute('''
+            SELECT label, patient_age, patient_gender, chief_complaint, soap_note
+            FROM notes WHERE id = ? AND user_id = ?
+        ''', (note_id, user_id))
+        return cursor.fetchone()
+
+@router.post("/{note_id}/email")
+async def email_note(note_id: int, user: sqlite3.Row = Depends(require_auth)):
+    # SQLite calls block (the reservation can wait on busy_timeout), so they run on
+    # worker threads like the SMTP send
+    row = await asyncio.to_thread(get_email_note, note_id, user["id"])
     
     if not row:
         raise HTTPException(status_code=404, detail="Note not found")
     
+    label, patient_age, patient_gender, chief_complaint, soap_note = row
+    
     # Use the note label (which has local time from frontend) or build from metadata
-    if row["label"]:
-        subject = "QIScribe Note — " + row["label"]
+    if label:
+        subject = f"QIScribe Note — {label}"
     else:
-        parts = []
-        if row["patient_age"]:
-            gender_char = row["patient_gender"][0].upper() if row["patient_gender"] else ""
-            parts.append(f"{row['patient_age']}{gender_char}")
-        if row["chief_complaint"]:
-            parts.append(row["chief_complaint"][:30])
-        subject = "QIScribe Note"
-        if parts:
-            subject += " — " + " · ".join(parts)
-    
-    # Send email
-    if not send_soap_note_email(user["email"], subject, row["soap_note"]):
-        raise HTTPException(status_code=500, detail="Failed to send email")
-    
-    record_email(user["id"], note_id)
+        gender_char = (patient_gender or "").strip()[:1].upper()
+        demographics = f"{patient_age}{gender_char}" if patient_age else ""
+        tail = " · ".join(filter(None, [demographics, (chief_complaint or "")[:30]]))
+        subject = f"QIScribe Note — {tail}" if tail else "QIScribe Note"
+    
+    # reserve_email's transaction is what enforces the limits across workers; this
+    # per-worker lock just queues a user's concurrent sends so they don't contend
+    # for SQLite's write lock or open parallel SMTP connections
+    async with email_locks[user["id"] % len(email_locks)]:
+        # Check rate limits and reserve a slot before sending
+        log_id, msg = await asyncio.to_thread(reserve_email, user["id"], note_id)
+        if log_id is None:
+            raise HTTPException(status_code=429, detail=msg)
+        
+        # Send email (smtplib blocks, so run it on a worker thread)
+        if not await asyncio.to_thread(send_soap_note_email, user["email"], subject, soap_note):
+            # Give the slot back; the email never went out
+            await asyncio.to_thread(release_email, log_id)
+            raise HTTPException(status_code=500, detail="Failed to send email")
     
     return {"message": "Email sent"}
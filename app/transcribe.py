@@ -1,68 +1,94 @@
-from fastapi import APIRouter, Request, HTTPException, UploadFile, File
-from openai import OpenAI
+from fastapi import APIRouter, HTTPException, UploadFile, File, Depends
+from openai import AsyncOpenAI
 import os
-import tempfile
+import mimetypes
+
+from app.auth import require_auth
 
 router = APIRouter(prefix="/api", tags=["transcribe"])
 
+MAX_AUDIO_BYTES = 25 * 1024 * 1024  # Whisper API limit
+
+# Upload content type (without parameters) -> file extension sent to Whisper
+# Whisper picks its decoder from the extension, so unlisted types fall back to the
+# substring checks the mapping replaced before trying mimetypes
+CONTENT_TYPE_EXTENSIONS = {
+    "audio/mp4": ".m4a",
+    "audio/m4a": ".m4a",
+    "audio/x-m4a": ".m4a",
+    "video/mp4": ".m4a",
+    "audio/mp4a-latm": ".m4a",
+    "audio/mpeg": ".mp3",
+    "audio/mp3": ".mp3",
+    "audio/x-mp3": ".mp3",
+    "audio/mpeg3": ".mp3",
+    "audio/x-mpeg": ".mp3",
+    "audio/x-mpeg-3": ".mp3",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/wave": ".wav",
+    "audio/vnd.wave": ".wav",
+    "audio/vnd.wav": ".wav",
+    "audio/ogg": ".ogg",
+    "audio/x-ogg": ".ogg",
+    "application/ogg": ".ogg",
+    "video/ogg": ".ogg",
+    "audio/webm": ".webm",
+    "video/webm": ".webm",
+}
+WHISPER_EXTENSIONS = {".flac", ".m4a", ".mp3", ".mp4", ".mpeg", ".mpga", ".oga", ".ogg", ".wav", ".webm"}
+
+def audio_extension(content_type: str) -> str:
+    base = content_type.split(";", 1)[0].strip().lower()
+    ext = CONTENT_TYPE_EXTENSIONS.get(base)
+    if ext is not None:
+        return ext
+    
+    content_type = content_type.lower()
+    if "mp4" in content_type or "m4a" in content_type:
+        return ".m4a"
+    if "mpeg" in content_type or "mp3" in content_type:
+        return ".mp3"
+    if "wav" in content_type:
+        return ".wav"
+    if "ogg" in content_type:
+        return ".ogg"
+    
+    ext = mimetypes.guess_extension(base) if base else None
+    return ext if ext in WHISPER_EXTENSIONS else ".webm"
+
 # Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-@router.post("/transcribe")
-async def transcribe_audio(request: Request, audio: UploadFile = File(...)):
+@router.post("/transcribe", dependencies=[Depends(require_auth)])
+async def transcribe_audio(audio: UploadFile = File(...)):
     """Transcribe audio using OpenAI Whisper API"""
     
-    # Check authentication (not async)
-    from app.auth import get_current_user
-    user = get_current_user(request)
-    if not user:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    # Read file content
-    content = await audio.read()
+    # Measure the spooled upload without reading it
+    audio.file.seek(0, os.SEEK_END)
+    size = audio.file.tell()
+    audio.file.seek(0)
     
-    if len(content) < 100:
+    if size < 100:
         raise HTTPException(status_code=400, detail="Audio file too small")
     
-    if len(content) > 25 * 1024 * 1024:  # 25MB limit
+    if size > MAX_AUDIO_BYTES:
         raise HTTPException(status_code=400, detail="Audio file too large (max 25MB)")
     
     # Determine extension from content type
     content_type = audio.content_type or ""
-    ext = ".webm"
-    if "mp4" in content_type or "m4a" in content_type:
-        ext = ".m4a"
-    elif "mpeg" in content_type or "mp3" in content_type:
-        ext = ".mp3"
-    elif "wav" in content_type:
-        ext = ".wav"
-    elif "ogg" in content_type:
-        ext = ".ogg"
+    ext = audio_extension(content_type)
     
     try:
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-            tmp.write(content)
-            tmp_path = tmp.name
-        
-        # Call Whisper API
-        with open(tmp_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="en",
-                response_format="text"
-            )
-        
-        # Clean up temp file
-        os.unlink(tmp_path)
+        # Call Whisper API, streaming the upload directly; the filename tells Whisper the format
+        transcript = await client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(f"audio{ext}", audio.file, content_type or "application/octet-stream"),
+            language="en",
+            response_format="text"
+        )
         
         return {"text": transcript.strip() if isinstance(transcript, str) else str(transcript)}
         
     except Exception as e:
-        # Clean up on error
-        if 'tmp_path' in locals():
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
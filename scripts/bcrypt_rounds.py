@@ -0,0 +1,37 @@
+"""Pick BCRYPT_ROUNDS for this host.
+
+Times bcrypt.hashpw at increasing cost factors and prints the highest one
+that stays under the budget. Run it once on the deployment host:
+
+    python scripts/bcrypt_rounds.py [budget_ms]
+"""
+import sys
+import time
+
+import bcrypt
+
+def time_hash(rounds: int, samples: int = 3) -> float:
+    salt = bcrypt.gensalt(rounds=rounds)
+    best = float("inf")
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"benchmark-password", salt)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 150.0
+    chosen = None
+    for rounds in range(8, 16):
+        ms = time_hash(rounds)
+        print(f"rounds={rounds:2d}  {ms:8.1f} ms")
+        if ms > budget_ms:
+            break
+        chosen = rounds
+    if chosen is None:
+        print(f"No cost factor fits within {budget_ms:.0f} ms")
+    else:
+        print(f"BCRYPT_ROUNDS={chosen}")
+
+if __name__ == "__main__":
+    main()